@@ -1,13 +1,21 @@
-import os
+import functools
+
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
 
 load_dotenv()
 
+
+@functools.lru_cache(maxsize=None)
+def _get_chat_model(model: str, temperature: float) -> ChatOpenAI:
+    """Share one client (and its HTTP session) per (model, temperature)."""
+    return ChatOpenAI(model=model, temperature=temperature)
+
+
 class LLMService:
-    
-    def __init__(self, model: str = "gpt-4o-mini"): 
-        self.llm = ChatOpenAI(model=model, temperature=0)
+
+    def __init__(self, model: str = "gpt-4o-mini"):
+        self.llm = _get_chat_model(model, 0)
 
     def get_llm(self):
         return self.llm
\ No newline at end of file
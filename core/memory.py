@@ -1,140 +1,288 @@
+import asyncio
+import atexit
+import functools
 import json
+import threading
 import tiktoken
 import os
-from typing import List, Optional
+from collections import deque
+from itertools import islice
+from typing import Deque, Optional
 from langchain_core.prompts import ChatPromptTemplate
 from pydantic import ValidationError
 
-from schema.definitions import ChatMessage, SummaryOutput, SessionSummary
+from schema.definitions import ChatMessage, SummaryOutput, PersistState
 from core.llm import LLMService
 from utils.logger import setup_logger
 
 logger = setup_logger("MemoryManager")
 
+
+@functools.lru_cache(maxsize=4)
+def _get_encoding(name: str):
+    """Loading the BPE table is expensive; share one encoder per name.
+
+    tiktoken encoders are thread-safe for encode().
+    """
+    return tiktoken.get_encoding(name)
+
 class MemoryManager:
+    FLUSH_DELAY_SECONDS = 0.5  # Debounce window for batched state writes
+
     def __init__(self, llm_service: LLMService, token_threshold: int = 500, persist_path: str = "data/memory_store.json"):
         self.llm = llm_service.get_llm()
         self.token_threshold = token_threshold
         self.persist_path = persist_path # Đường dẫn file lưu trữ
 
-        self.history: List[ChatMessage] = []
+        # deque: summarization drops the oldest half without a full-list copy
+        self.history: Deque[ChatMessage] = deque()
         self.summary_output: Optional[SummaryOutput] = None
-        self.summarized_count = 0 
+        self.summarized_count = 0
+        # Bumped on every mutation; lets callers key caches on memory state
+        self.version = 0
+
+        # Incremental token accounting: per-message counts + running sum,
+        # so get_token_count never re-encodes the whole history
+        self._msg_tokens: Deque[int] = deque()
+        self._running_tokens = 0
+        self._summary_tokens = 0
 
-        self.tokenizer = tiktoken.get_encoding("cl100k_base")
-        self.summary_chain = self.llm.with_structured_output(SummaryOutput)
+        # Pre-rendered "role: content" lines and summary JSON, so get_context
+        # does not rebuild the whole context string on every query
+        self._history_lines: Deque[str] = deque()
+        self._summary_json_cache: Optional[tuple] = None  # (id(summary_output), json str)
+
+        # Debounced persistence: writes are coalesced instead of hitting disk per message
+        self._dirty = False
+        self._flush_timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        # Serializes the tmp-write + rename so a timer-thread flush and a
+        # checkpoint flush never run save_state concurrently
+        self._write_lock = threading.Lock()
+        atexit.register(self.flush)
+
+        self.tokenizer = _get_encoding("cl100k_base")
+        # Prompt is static -> compile the summarization chain once
+        self.summary_prompt = ChatPromptTemplate.from_messages([
+            ("system",
+             "You are a session memory summarizer. Update the JSON summary based on the NEW messages.\n"
+             "Return ONLY valid JSON matching the SummaryOutput schema."
+            ),
+            ("human",
+             "Current Summary (JSON): {current_summary}\n\n"
+             "New Messages to Absorb:\n{new_messages}\n"
+            )
+        ])
+        self.summary_chain = self.summary_prompt | self.llm.with_structured_output(SummaryOutput)
 
     # -------- Persistence --------
     def save_state(self):
         """Save all state into file JSON."""
         try:
             os.makedirs(os.path.dirname(self.persist_path), exist_ok=True)
-            
-            state = {
-                "history": [m.model_dump() for m in self.history],
-                "summary_output": self.summary_output.model_dump(by_alias=True) if self.summary_output else None,
-                "summarized_count": self.summarized_count
-            }
-            
-            with open(self.persist_path, 'w', encoding='utf-8') as f:
-                json.dump(state, f, indent=2, ensure_ascii=False)
+
+            # Serialize in one pass via pydantic-core (no intermediate dicts + json.dump)
+            payload = PersistState(
+                history=list(self.history),
+                summary_output=self.summary_output,
+                summarized_count=self.summarized_count
+            )
+            raw = payload.model_dump_json(by_alias=True, exclude_none=True)
+
+            # Write to a sibling temp file then rename, so a crash mid-write
+            # never leaves a truncated store behind. The lock keeps two
+            # writers from sharing the same tmp file.
+            with self._write_lock:
+                tmp_path = self.persist_path + ".tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(raw.encode('utf-8'))
+                os.replace(tmp_path, self.persist_path)
             logger.info(f"Memory state saved to {self.persist_path}")
             
         except Exception as e:
             logger.error(f"Failed to save memory state: {str(e)}")
 
+    def _mark_dirty(self):
+        """Flag state as changed and (re)arm the debounced flush timer."""
+        with self._lock:
+            self._dirty = True
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.FLUSH_DELAY_SECONDS, self._flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _flush(self):
+        with self._lock:
+            self._flush_timer = None
+            if not self._dirty:
+                return
+            self._dirty = False
+        self.save_state()
+
+    def flush(self):
+        """Force-flush pending state to disk (critical checkpoints / shutdown)."""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._dirty:
+                return
+            self._dirty = False
+        self.save_state()
+
     def load_state(self):
         if not os.path.exists(self.persist_path):
             logger.warning(f"No persistence file found at {self.persist_path}. Starting fresh.")
             return
 
         try:
-            with open(self.persist_path, 'r', encoding='utf-8') as f:
-                state = json.load(f)
-            
-            self.history = [ChatMessage(**m) for m in state.get("history", [])]
-            
-            summary_data = state.get("summary_output")
-            if summary_data:
-                self.summary_output = SummaryOutput(**summary_data)
-            
-            self.summarized_count = state.get("summarized_count", 0)
+            with open(self.persist_path, 'rb') as f:
+                raw = f.read()
+
+            if os.environ.get("MEMORY_VALIDATE_ON_LOAD"):
+                # Defense-in-depth: full validation in a single pydantic-core pass
+                state = PersistState.model_validate_json(raw)
+                self.history = deque(state.history)
+                self.summary_output = state.summary_output
+                self.summarized_count = state.summarized_count
+            else:
+                # File is self-produced -> skip per-message validator dispatch
+                data = json.loads(raw)
+                self.history = deque(ChatMessage.model_construct(**m) for m in data.get("history", []))
+                summary_data = data.get("summary_output")
+                if summary_data:
+                    self.summary_output = SummaryOutput.model_validate(summary_data)
+                self.summarized_count = data.get("summarized_count", 0)
+
+            # Rebuild the token accounting for the restored history
+            self._msg_tokens = deque(len(self.tokenizer.encode(m.content)) for m in self.history)
+            self._running_tokens = sum(self._msg_tokens)
+            self._history_lines = deque(f"{m.role}: {m.content}" for m in self.history)
+            self._summary_json_cache = None
+            self._summary_tokens = (
+                len(self.tokenizer.encode(self._summary_json())) if self.summary_output else 0
+            )
+            self.version += 1
+
             logger.info(f"Memory state loaded. History: {len(self.history)} msgs, Summary exists: {bool(self.summary_output)}")
             
         except (json.JSONDecodeError, ValidationError) as e:
             logger.error(f"Corrupted memory file: {str(e)}. Starting fresh.")
 
     # -------- Public API --------
-    def add_message(self, role: str, content: str):
+    def _append(self, role: str, content: str):
         self.history.append(ChatMessage(role=role, content=content))
-        # Auto save after each message
-        self.save_state() 
+        self._history_lines.append(f"{role}: {content}")
+        n = len(self.tokenizer.encode(content))
+        self._msg_tokens.append(n)
+        self._running_tokens += n
+        self.version += 1
+        # Debounced save: coalesces rapid messages into one write
+        self._mark_dirty()
+
+    def add_message(self, role: str, content: str):
+        self._append(role, content)
         self._check_and_summarize()
 
+    async def aadd_message(self, role: str, content: str):
+        """Async add: the caller is not blocked on the summarization RTT or disk."""
+        self._append(role, content)
+        if self._over_threshold():
+            await self._arun_summarization()
+
+    def _summary_json(self) -> str:
+        """Rendered summary JSON, re-dumped only when a new summary is assigned."""
+        if self.summary_output is None:
+            return ""
+        if self._summary_json_cache is None or self._summary_json_cache[0] != id(self.summary_output):
+            self._summary_json_cache = (
+                id(self.summary_output),
+                self.summary_output.model_dump_json(by_alias=True)
+            )
+        return self._summary_json_cache[1]
+
     # -------- Token counting --------
     def get_token_count(self) -> int:
-        text = "".join([m.content for m in self.history])
-        summary_json = self.summary_output.model_dump_json(by_alias=True) if self.summary_output else ""
-        return len(self.tokenizer.encode(text + summary_json))
+        # Both terms are maintained where state changes; nothing to encode here
+        return self._running_tokens + self._summary_tokens
 
     # -------- Trigger logic --------
-    def _check_and_summarize(self):
+    def _over_threshold(self) -> bool:
         curr = self.get_token_count()
         logger.info(f"Token usage: {curr}/{self.token_threshold}")
-        
+
         if curr > self.token_threshold:
             logger.info("Triggering summarization...")
+            return True
+        return False
+
+    def _check_and_summarize(self):
+        if self._over_threshold():
             self._run_summarization()
 
     # -------- Summarization (With Error Handling) --------
-    def _run_summarization(self):
+    def _summarization_inputs(self):
+        """Chuẩn bị input chung cho cả invoke và ainvoke."""
         mid_idx = len(self.history) // 2
         if mid_idx == 0:
-            return
+            return 0, None
 
-        msgs_to_process = self.history[:mid_idx]
-        msgs_text = "\n".join([f"{m.role}: {m.content}" for m in msgs_to_process])
+        msgs_text = "\n".join(islice(self._history_lines, mid_idx))
+        current_summary = self._summary_json() if self.summary_output else "{}"
+        return mid_idx, {"current_summary": current_summary, "new_messages": msgs_text}
 
-        current_summary = (
-            self.summary_output.session_summary.model_dump_json(by_alias=True)
-            if self.summary_output else "{}"
-        )
+    def _apply_summary(self, result: SummaryOutput, mid_idx: int):
+        self.summarized_count += mid_idx
 
-        prompt = ChatPromptTemplate.from_messages([
-            ("system",
-             "You are a session memory summarizer. Update the JSON summary based on the NEW messages.\n"
-             "Return ONLY valid JSON matching the SummaryOutput schema."
-            ),
-            ("human",
-             "Current Summary (JSON): {current_summary}\n\n"
-             "New Messages to Absorb:\n{new_messages}\n"
-            )
-        ])
+        result.message_range_summarized.from_index = 0
+        result.message_range_summarized.to_index = self.summarized_count - 1
+
+        self.summary_output = result
+        # Re-tokenize the summary once, at the only point it changes
+        self._summary_tokens = len(self.tokenizer.encode(self._summary_json()))
+        # Drop the summarized half from the left without copying the rest
+        for _ in range(mid_idx):
+            self.history.popleft()
+            self._history_lines.popleft()
+            self._running_tokens -= self._msg_tokens.popleft()
+        self.version += 1
+
+        logger.info(f"Summary Updated Successfully. Range 0 -> {self.summarized_count - 1}")
+        with self._lock:
+            self._dirty = True
+
+    def _run_summarization(self):
+        mid_idx, inputs = self._summarization_inputs()
+        if not inputs:
+            return
 
-        chain = prompt | self.summary_chain
-        
         try:
             # [Safe Invoke]
-            result: SummaryOutput = chain.invoke({
-                "current_summary": current_summary,
-                "new_messages": msgs_text
-            })
+            result: SummaryOutput = self.summary_chain.invoke(inputs)
 
             if result:
-                processed_count = len(msgs_to_process)
-                self.summarized_count += processed_count
-
-                result.message_range_summarized.from_index = 0
-                result.message_range_summarized.to_index = self.summarized_count - 1
-
-                self.summary_output = result
-                self.history = self.history[mid_idx:]
-                
-                logger.info(f"Summary Updated Successfully. Range 0 -> {self.summarized_count - 1}")
-                self.save_state() # Lưu ngay sau khi tóm tắt
-                
+                self._apply_summary(result, mid_idx)
+                self.flush() # Lưu ngay sau khi tóm tắt
+
+        except Exception as e:
+
+            logger.error(f"Summarization failed: {str(e)}")
+            logger.warning("Skipping summarization this turn.")
+
+    async def _arun_summarization(self):
+        mid_idx, inputs = self._summarization_inputs()
+        if not inputs:
+            return
+
+        try:
+            result: SummaryOutput = await self.summary_chain.ainvoke(inputs)
+
+            if result:
+                self._apply_summary(result, mid_idx)
+                # Persist off the event loop
+                await asyncio.to_thread(self.flush)
+
         except Exception as e:
-            
             logger.error(f"Summarization failed: {str(e)}")
             logger.warning("Skipping summarization this turn.")
 
@@ -142,8 +290,8 @@ class MemoryManager:
     def get_context(self) -> str:
         ctx = ""
         if self.summary_output:
-            ctx += "SUMMARY_OUTPUT (JSON):\n" + self.summary_output.model_dump_json(by_alias=True) + "\n"
-        ctx += "\nRECENT MESSAGES:\n" + "\n".join([f"{m.role}: {m.content}" for m in self.history])
+            ctx += "SUMMARY_OUTPUT (JSON):\n" + self._summary_json() + "\n"
+        ctx += "\nRECENT MESSAGES:\n" + "\n".join(self._history_lines)
         return ctx
     
     
@@ -155,5 +303,6 @@ class MemoryManager:
         Sử dụng by_alias=True để giữ key 'from', 'to' đúng theo schema yêu cầu.
         """
         if self.summary_output:
-            return self.summary_output.model_dump(by_alias=True)
+            # Reuse the cached JSON render instead of a fresh model_dump
+            return json.loads(self._summary_json())
         return {}
\ No newline at end of file
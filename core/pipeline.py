@@ -1,3 +1,6 @@
+from collections import OrderedDict
+from typing import List, Optional
+
 from langchain_core.prompts import ChatPromptTemplate
 from schema.definitions import QueryUnderstandingOutput, _ALLOWED_KEYS
 from core.llm import LLMService
@@ -7,18 +10,23 @@ from utils.logger import setup_logger
 logger = setup_logger("QueryPipeline")
 
 class QueryPipeline:
+    CACHE_MAX_ENTRIES = 128
+
     def __init__(self, llm_service: LLMService, memory_manager: MemoryManager):
         self.llm = llm_service.get_llm()
         self.memory = memory_manager
         self.parser_llm = self.llm.with_structured_output(QueryUnderstandingOutput)
         self.valid_keys_str = ", ".join([f"'{k}'" for k in _ALLOWED_KEYS])
+        # Prompt + chain are immutable -> build once, with the constant key
+        # list baked in so only {context} and {query} are formatted per call
+        self.prompt = self._build_prompt().partial(valid_keys_list=self.valid_keys_str)
+        self.chain = self.prompt | self.parser_llm
+        # LRU of analyzed queries, keyed by (query, memory.version) so a
+        # memory mutation naturally invalidates stale entries
+        self._result_cache: "OrderedDict[tuple, QueryUnderstandingOutput]" = OrderedDict()
 
-    def process_query(self, user_query: str) -> QueryUnderstandingOutput:
-        context_str = self.memory.get_context()
-        
-        logger.info(f"Processing query: '{user_query}'")
-
-        prompt = ChatPromptTemplate.from_messages([
+    def _build_prompt(self) -> ChatPromptTemplate:
+        return ChatPromptTemplate.from_messages([
             ("system", 
              "You are an intelligent query understanding engine. Analyze the user query based on the CONTEXT.\n"
              "Perform the following steps:\n"
@@ -32,26 +40,79 @@ class QueryPipeline:
             ("human", "CONTEXT:\n{context}\n\nUSER QUERY: {query}")
         ])
 
-        chain = prompt | self.parser_llm
-        
+    def _cache_get(self, user_query: str):
+        key = (user_query, self.memory.version)
+        result = self._result_cache.get(key)
+        if result is not None:
+            self._result_cache.move_to_end(key)
+        return result
+
+    def _cache_put(self, user_query: str, result: QueryUnderstandingOutput):
+        self._result_cache[(user_query, self.memory.version)] = result
+        while len(self._result_cache) > self.CACHE_MAX_ENTRIES:
+            self._result_cache.popitem(last=False)
+
+    def _fallback_output(self, user_query: str, context_str: str) -> QueryUnderstandingOutput:
+        return QueryUnderstandingOutput(
+            original_query=user_query,
+            is_ambiguous=False,
+            rewritten_query=user_query,
+            needed_context_from_memory=[],
+            clarifying_questions=[],
+            final_augmented_context=context_str[-1000:]
+        )
+
+    def process_query(self, user_query: str) -> QueryUnderstandingOutput:
+        cached = self._cache_get(user_query)
+        if cached is not None:
+            logger.info(f"Cache hit for query: '{user_query}'")
+            return cached
+
+        context_str = self.memory.get_context()
+
+        logger.info(f"Processing query: '{user_query}'")
+
         try:
-            result = chain.invoke({
+            result = self.chain.invoke({
                 "context": context_str,
-                "query": user_query,
-                "valid_keys_list": self.valid_keys_str # Inject danh sách key
+                "query": user_query
             })
-            
+
             # Log kết quả để kiểm tra
             logger.info(f"Analyzed: Ambiguous={result.is_ambiguous}, Keys={result.needed_context_from_memory}")
+            self._cache_put(user_query, result)
             return result
-            
+
         except Exception as e:
             logger.error(f"LLM Query Processing failed: {str(e)}")
-            return QueryUnderstandingOutput(
-                original_query=user_query,
-                is_ambiguous=False,
-                rewritten_query=user_query,
-                needed_context_from_memory=[],
-                clarifying_questions=[],
-                final_augmented_context=context_str[-1000:]
-            )
\ No newline at end of file
+            return self._fallback_output(user_query, context_str)
+
+    def process_queries(self, user_queries: List[str]) -> List[QueryUnderstandingOutput]:
+        """Xử lý nhiều query độc lập trong một lần batch (song song phía provider)."""
+        context_str = self.memory.get_context()
+
+        outputs: List[Optional[QueryUnderstandingOutput]] = [
+            self._cache_get(q) for q in user_queries
+        ]
+        misses = [i for i, out in enumerate(outputs) if out is None]
+
+        logger.info(f"Processing batch of {len(user_queries)} queries ({len(misses)} uncached)")
+
+        if misses:
+            inputs = [
+                {"context": context_str, "query": user_queries[i]}
+                for i in misses
+            ]
+
+            results = self.chain.batch(inputs, config={"max_concurrency": 8}, return_exceptions=True)
+
+            for i, result in zip(misses, results):
+                q = user_queries[i]
+                if isinstance(result, Exception):
+                    logger.error(f"LLM Query Processing failed for '{q}': {str(result)}")
+                    outputs[i] = self._fallback_output(q, context_str)
+                else:
+                    logger.info(f"Analyzed: Ambiguous={result.is_ambiguous}, Keys={result.needed_context_from_memory}")
+                    self._cache_put(q, result)
+                    outputs[i] = result
+        return outputs
\ No newline at end of file
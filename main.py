@@ -1,8 +1,25 @@
+import atexit
 import os
 import sys
 import json
-import time
-import logging
+from pathlib import Path
+
+try:
+    import orjson
+
+    def _json_loads(data):
+        return orjson.loads(data)
+
+    def _json_dumps(data, pretty=False):
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if pretty else 0)
+
+except ImportError:
+    # Fallback: stdlib json keeps the demo runnable without orjson
+    def _json_loads(data):
+        return json.loads(data)
+
+    def _json_dumps(data, pretty=False):
+        return json.dumps(data, indent=2 if pretty else None, ensure_ascii=False).encode('utf-8')
 
 from core.llm import LLMService
 from core.memory import MemoryManager
@@ -21,41 +38,47 @@ class DualLogger(object):
     def __init__(self, filepath):
         self.terminal = sys.stdout
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
-        self.log = open(filepath, "w", encoding='utf-8')
+        # Line buffering: flushed per newline instead of per write() call
+        self.log = open(filepath, "w", encoding='utf-8', buffering=1)
+        # Make sure a trailing partial line reaches disk at shutdown
+        atexit.register(self.log.close)
 
     def write(self, message):
         self.terminal.write(message)
         self.log.write(message)
-        self.log.flush()
 
     def flush(self):
         self.terminal.flush()
         self.log.flush()
 
-def save_json_result(filename, data):
-    filepath = os.path.join(DATA_DIR, filename)
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+def save_json_result(filename, data, pretty=False):
+    filepath = Path(DATA_DIR) / filename
+
+    raw = _json_dumps(data)
+    # Indent only human-read files, and only while they stay small
+    if pretty and len(raw) <= 1_000_000:
+        raw = _json_dumps(data, pretty=True)
+
+    tmp_path = filepath.with_name(filepath.name + ".tmp")
+    tmp_path.write_bytes(raw)
+    os.replace(tmp_path, filepath)
     print(f"\n[System] Saved result to: {filepath}")
 
 def load_data_smart(filepath):
-    if not os.path.exists(filepath):
+    path = Path(filepath)
+    if not path.exists():
         logger.error(f"File not found: {filepath}")
         return []
 
-    data = []
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            first_char = f.read(1)
-            f.seek(0)
-            
-            if first_char == '[':
-                data = json.load(f)
-            else:
-                for line in f:
-                    if line.strip():
-                        data.append(json.loads(line))
-        
+        raw = path.read_bytes()
+
+        # One read, no seek: sniff the format from the buffer itself
+        if raw.lstrip()[:1] == b'[':
+            data = _json_loads(raw)
+        else:
+            data = [_json_loads(line) for line in raw.splitlines() if line.strip()]
+
         logger.info(f"Loaded {len(data)} items from {filepath}")
         return data
     except Exception as e:
@@ -100,12 +123,11 @@ def run_demo():
             print(f"[{i+1}] [{display_role}]: {content[:60]}...")
             
             memory.add_message(role, content)
-            time.sleep(0.05)
-            
+
         summary_dict = memory.export_summary_output()
         print("\n[Result] Final Session Summary:")
         print(json.dumps(summary_dict, indent=2))
-        save_json_result("output/output_session_summary.json", summary_dict)
+        save_json_result("output/output_session_summary.json", summary_dict, pretty=True)
     else:
         print(f"[WARNING] Skipping Flow 1 because {CONV_FILE} is empty or missing.")
 
@@ -117,6 +139,8 @@ def run_demo():
     flow2_results = []
 
     if queries:
+        # Collect every query first so the pipeline can batch them in one call
+        pending_queries = []
         for item in queries:
             if isinstance(item, dict):
                 q = item.get('query')
@@ -126,12 +150,13 @@ def run_demo():
                 continue
 
             if not q: continue
+            pending_queries.append(q)
 
+        outputs = pipeline.process_queries(pending_queries)
+
+        for q, output in zip(pending_queries, outputs):
             print(f"\nUser Query: '{q}'")
-            
-            # Run Pipeline
-            output = pipeline.process_query(q)
-            
+
             print(f" -> Is Ambiguous: {output.is_ambiguous}")
             if output.is_ambiguous:
                  print(f" -> Rewritten: {output.rewritten_query}")
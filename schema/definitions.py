@@ -1,4 +1,4 @@
-from typing import List, Optional, Set
+from typing import List, Optional
 from pydantic import BaseModel, Field, field_validator
 
 class ChatMessage(BaseModel):
@@ -25,6 +25,12 @@ class SummaryOutput(BaseModel):
     session_summary: SessionSummary
     message_range_summarized: MessageRange
 
+class PersistState(BaseModel):
+    """Wrapper cho toàn bộ state của MemoryManager khi lưu xuống file."""
+    history: List[ChatMessage] = Field(default_factory=list)
+    summary_output: Optional[SummaryOutput] = None
+    summarized_count: int = 0
+
 
 def get_allowed_keys_info():
     """
@@ -40,10 +46,10 @@ def get_allowed_keys_info():
     for k in UserProfile.model_fields.keys():
         full_key = f"user_profile.{k}"
         allowed.add(full_key)
-        mapping[k] = full_key 
+        mapping[k] = full_key
         mapping[full_key] = full_key
-        
-    return allowed, mapping
+
+    return frozenset(allowed), mapping
 
 _ALLOWED_KEYS, _KEY_MAPPING = get_allowed_keys_info()
 
@@ -61,20 +67,18 @@ class QueryUnderstandingOutput(BaseModel):
         if not v:
             return []
             
-        cleaned = []
+        # Dedupe via dict keys: order-preserving, cheaper than list(set(...))
+        cleaned = {}
         for item in v:
-            item = item.strip()
-            
-            if item.startswith("session_summary."):
-                item = item.replace("session_summary.", "")
-            
+            item = item.strip().removeprefix("session_summary.")
+
             mapped_key = _KEY_MAPPING.get(item)
-            
+
             if mapped_key:
-                cleaned.append(mapped_key)
+                cleaned[mapped_key] = None
             else:
                 # [DEBUG LOG] Uncomment dòng dưới nếu muốn soi lỗi
                 # print(f"DEBUG: Rejected key '{item}' - Not in allowed list")
                 pass
-                
-        return list(set(cleaned))
\ No newline at end of file
+
+        return list(cleaned)
\ No newline at end of file